@@ -16,18 +16,33 @@ Requirements:
   SUPPORT_USERNAME=metopo
   REVEAL_PRICE_STARS=25
   DB_PATH=anon_bot.db
+  LOG_LEVEL=INFO
+  LOG_DEBUG_SAMPLE=0.01
 """
 
 import os
+import sys
+import copy
+import json
+import math
+import queue
+import uuid
+import atexit
+import random
+import asyncio
 import sqlite3
 import time
+import hashlib
 import logging
+import logging.handlers
+import contextvars
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 load_dotenv()
@@ -42,6 +57,17 @@ BOT_USERNAME = os.getenv("BOT_USERNAME", "whosent_bot")
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "")
 REVEAL_PRICE_STARS = int(os.getenv("REVEAL_PRICE_STARS", "25"))
 DB_PATH = os.getenv("DB_PATH", "anon_bot.db")
+SEARCH_PAGE_SIZE = 10
+INBOX_PAGE_SIZE = 10
+THREAD_PAGE_SIZE = 8       # 8 replies of THREAD_TEXT_LIMIT chars + root stay well under Telegram's 4096
+THREAD_TEXT_LIMIT = 300
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))   # messages per second, Telegram allows ~30
+BROADCAST_BATCH = 500                                       # user ids fetched per keyset batch
+BROADCAST_PROGRESS_EVERY = 5                                # seconds between progress message edits
+HLL_P = 12                                   # 4096 registers per sketch
+HLL_ERROR = 1.04 / math.sqrt(1 << HLL_P)     # ~1.6% standard error
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0"))  # share of updates that log hot-path debug lines
 
 if not BOT_TOKEN:
     raise SystemExit("BOT_TOKEN is required in .env")
@@ -49,7 +75,78 @@ if not BOT_TOKEN:
 # ----------------------------
 # Logging
 # ----------------------------
-logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# Handlers only put records on a queue; a background thread formats them as JSON and writes to stdout.
+# Each update runs with its own log context (correlation id, user id, route), see log_context_middleware.
+log_context = contextvars.ContextVar("log_context", default=None)
+
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "cid", "user_id", "route"}
+
+class LogContextFilter(logging.Filter):
+    # runs in the caller's thread/task, so the contextvar of the current update is visible here
+    def filter(self, record):
+        ctx = log_context.get()
+        if ctx:
+            record.cid = ctx["cid"]
+            record.user_id = ctx["user_id"]
+            record.route = ctx["route"]
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # render message args and traceback now; keep the rest of the record for the JSON formatter.
+        # work on a copy like the stdlib does, other handlers may still see the caller's record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("cid", "user_id", "route"):
+            if hasattr(record, key):
+                entry[key] = getattr(record, key)
+        # anything passed via extra={...}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+
+def debug_sampled():
+    # True for updates picked by LOG_DEBUG_SAMPLE; guard hot-path log_debug calls with it
+    ctx = log_context.get()
+    return bool(ctx and ctx["sampled"])
+
+def log_debug(msg, **fields):
+    # emitted at DEBUG regardless of LOG_LEVEL, sampling already decided that it is wanted
+    logger.handle(logger.makeRecord(logger.name, logging.DEBUG, __file__, 0, msg, None, None, extra=fields))
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # ----------------------------
@@ -58,6 +155,32 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+@dp.update.outer_middleware()
+async def log_context_middleware(handler, update: types.Update, data):
+    user = None
+    route = update.event_type
+    if update.message:
+        user = update.message.from_user
+        text = update.message.text or ""
+        if text.startswith("/"):
+            route = text.split()[0]
+    elif update.callback_query:
+        user = update.callback_query.from_user
+        route = "callback:" + (update.callback_query.data or "").split(":", 1)[0]
+    ctx = {
+        "cid": uuid.uuid4().hex[:12],
+        "user_id": user.id if user else None,
+        "route": route,
+        "sampled": LOG_DEBUG_SAMPLE > 0 and random.random() < LOG_DEBUG_SAMPLE,
+    }
+    token = log_context.set(ctx)
+    started = time.perf_counter()
+    try:
+        return await handler(update, data)
+    finally:
+        logger.info("update handled", extra={"duration_ms": round((time.perf_counter() - started) * 1000, 2)})
+        log_context.reset(token)
+
 # ----------------------------
 # In-memory states (simple)
 # ----------------------------
@@ -65,6 +188,10 @@ pending_send_for_target = {}         # sender_id -> target_id
 pending_reply_for_message = {}       # replier_id -> message_id
 pending_idea_from_user = {}          # user_id -> True (user is entering idea text)
 pending_appeal_from_user = {}        # user_id -> True (entering appeal text)
+admin_search_query = {}              # admin_id -> (scope, query) of the last /search
+broadcast_status = {}                # broadcast_id -> running/paused/cancelled (checked by the sender loop)
+broadcast_tasks = {}                 # broadcast_id -> asyncio.Task
+broadcast_next_send = 0.0            # monotonic time of the next free send slot, shared by all broadcasts
 
 # ----------------------------
 # Translations (all texts duplicated ru/en)
@@ -174,6 +301,30 @@ TEXT = {
     "reveal_prompt": {
         "ru": "⭐ Раскрыть отправителя стоит {price}★ (симуляция).",
         "en": "⭐ Reveal sender costs {price}★ (simulation)."
+    },
+    "inbox_header": {
+        "ru": "📥 Входящие сообщения:",
+        "en": "📥 Received messages:"
+    },
+    "inbox_empty": {
+        "ru": "📭 Вам пока никто не написал.",
+        "en": "📭 Nobody has written to you yet."
+    },
+    "thread_header": {
+        "ru": "🧵 Переписка по сообщению #{mid}:\n\n{text}",
+        "en": "🧵 Thread for message #{mid}:\n\n{text}"
+    },
+    "thread_no_replies": {
+        "ru": "Ответов пока нет.",
+        "en": "No replies yet."
+    },
+    "thread_you": {
+        "ru": "Вы",
+        "en": "You"
+    },
+    "thread_them": {
+        "ru": "Собеседник",
+        "en": "Them"
     }
 }
 
@@ -247,10 +398,106 @@ def init_db():
         processed INTEGER DEFAULT 0
     );
     """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS replies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER,
+        author_id INTEGER,
+        recipient_id INTEGER,
+        text TEXT,
+        created_at INTEGER
+    );
+    """)
+    # keyset pagination indexes: inbox by receiver, thread replies by root message
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_replies_message ON replies (message_id, id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        status TEXT DEFAULT 'running',
+        last_user_id INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        progress_message_id INTEGER,
+        created_at INTEGER,
+        finished_at INTEGER
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT,
+        error TEXT,
+        created_at INTEGER,
+        PRIMARY KEY (broadcast_id, user_id)
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_sketches (
+        day TEXT,
+        metric TEXT,
+        registers BLOB,
+        PRIMARY KEY (day, metric)
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS daily_counters (
+        day TEXT,
+        metric TEXT,
+        value INTEGER DEFAULT 0,
+        PRIMARY KEY (day, metric)
+    );
+    """)
+    init_search_index(cur)
     con.commit()
     con.close()
 
-def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False):
+def init_search_index(cur):
+    # FTS5 indexes over messages.text and reports.reason (external content, kept in sync by triggers)
+    existing = {r[0] for r in cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('messages_fts', 'reports_fts')").fetchall()}
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    """)
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(
+        reason,
+        content='reports',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    """)
+    for table, fts, col in (("messages", "messages_fts", "text"), ("reports", "reports_fts", "reason")):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts}(rowid, {col}) VALUES (new.id, new.{col});
+        END;
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.id, old.{col});
+        END;
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.id, old.{col});
+            INSERT INTO {fts}(rowid, {col}) VALUES (new.id, new.{col});
+        END;
+        """)
+        # migration: backfill rows written before the index existed
+        if fts not in existing:
+            cur.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False, lastrowid=False):
+    started = time.perf_counter()
     con = sqlite3.connect(DB_PATH)
     cur = con.cursor()
     cur.execute(query, params)
@@ -259,15 +506,20 @@ def db_execute(query, params=(), fetchone=False, fetchall=False, commit=False):
         result = cur.fetchone()
     if fetchall:
         result = cur.fetchall()
+    if lastrowid:
+        result = cur.lastrowid
     if commit:
         con.commit()
     con.close()
+    if debug_sampled():
+        log_debug("db_execute", query=" ".join(query.split())[:120], duration_ms=round((time.perf_counter() - started) * 1000, 2))
     return result
 
 # ----------------------------
 # DB helpers
 # ----------------------------
 def ensure_user(user_id, username=None, first_name=None):
+    track_unique("active_users", user_id)
     row = db_execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,), fetchone=True)
     if not row:
         db_execute("INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
@@ -287,18 +539,55 @@ def create_visit(visitor_id, target_id):
     ts = int(time.time())
     db_execute("INSERT INTO visits (visitor_id, target_id, created_at) VALUES (?, ?, ?)",
                (visitor_id, target_id, ts), commit=True)
+    track_counter("visits")
+    track_unique("visitors", visitor_id)
 
 def create_message(sender_id, sender_username, sender_first_name, receiver_id, text):
     ts = int(time.time())
-    db_execute("INSERT INTO messages (sender_id, sender_username, sender_first_name, receiver_id, text, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-               (sender_id, sender_username, sender_first_name, receiver_id, text, ts), commit=True)
+    mid = db_execute("INSERT INTO messages (sender_id, sender_username, sender_first_name, receiver_id, text, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (sender_id, sender_username, sender_first_name, receiver_id, text, ts), commit=True, lastrowid=True)
     db_execute("UPDATE users SET messages_received = messages_received + 1 WHERE user_id = ?", (receiver_id,), commit=True)
-    res = db_execute("SELECT last_insert_rowid()", fetchone=True)
-    return res[0]
+    track_counter("messages")
+    track_unique("senders", sender_id)
+    track_unique("receivers", receiver_id)
+    return mid
 
 def get_message(mid):
     return db_execute("SELECT id, sender_id, sender_username, sender_first_name, receiver_id, text, revealed, created_at FROM messages WHERE id = ?", (mid,), fetchone=True)
 
+def add_reply(message_id, author_id, recipient_id, text):
+    ts = int(time.time())
+    return db_execute("INSERT INTO replies (message_id, author_id, recipient_id, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                      (message_id, author_id, recipient_id, text, ts), commit=True, lastrowid=True)
+
+def fetch_keyset_page(query, params, cursor=0, direction="older", page_size=INBOX_PAGE_SIZE):
+    # query selects rows with `id` as first column and must end with a WHERE clause we can extend.
+    # Returns (rows newest first, has_older, has_newer); cost does not depend on how deep the page is.
+    if direction == "newer":
+        rows = db_execute(f"{query} AND id > ? ORDER BY id ASC LIMIT ?", (*params, cursor, page_size + 1), fetchall=True) or []
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_older = bool(rows) and bool(db_execute(f"{query} AND id < ? LIMIT 1", (*params, rows[-1][0]), fetchone=True))
+    else:
+        if cursor:
+            rows = db_execute(f"{query} AND id < ? ORDER BY id DESC LIMIT ?", (*params, cursor, page_size + 1), fetchall=True) or []
+        else:
+            rows = db_execute(f"{query} ORDER BY id DESC LIMIT ?", (*params, page_size + 1), fetchall=True) or []
+        has_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_newer = bool(rows) and bool(db_execute(f"{query} AND id > ? LIMIT 1", (*params, rows[0][0]), fetchone=True))
+    return rows, has_older, has_newer
+
+def get_inbox_page(user_id, cursor=0, direction="older"):
+    return fetch_keyset_page("""
+        SELECT id, text, created_at, (SELECT COUNT(*) FROM replies r WHERE r.message_id = messages.id)
+        FROM messages WHERE receiver_id = ?
+    """, (user_id,), cursor, direction)
+
+def get_thread_page(message_id, cursor=0, direction="older"):
+    return fetch_keyset_page("SELECT id, author_id, text, created_at FROM replies WHERE message_id = ?",
+                             (message_id,), cursor, direction, THREAD_PAGE_SIZE)
+
 def add_report(message_id, reporter_id, reason):
     ts = int(time.time())
     db_execute("INSERT INTO reports (message_id, reporter_id, reason, created_at) VALUES (?, ?, ?, ?)",
@@ -338,9 +627,7 @@ def is_blocked(user_id):
 
 def save_appeal(user_id, text):
     ts = int(time.time())
-    db_execute("INSERT INTO appeals (user_id, text, created_at) VALUES (?, ?, ?)", (user_id, text, ts), commit=True)
-    res = db_execute("SELECT last_insert_rowid()", fetchone=True)
-    return res[0]
+    return db_execute("INSERT INTO appeals (user_id, text, created_at) VALUES (?, ?, ?)", (user_id, text, ts), commit=True, lastrowid=True)
 
 def get_unprocessed_appeals():
     return db_execute("SELECT id, user_id, text, created_at FROM appeals WHERE processed = 0", fetchall=True) or []
@@ -352,6 +639,127 @@ def save_idea(from_user, text):
     ts = int(time.time())
     db_execute("INSERT INTO ideas (from_user, text, created_at) VALUES (?, ?, ?)", (from_user, text, ts), commit=True)
 
+def fts_query(text):
+    # quote every token so user input (phone numbers, "+", "-", quotes) is never parsed as FTS syntax
+    tokens = [tok.replace('"', '""') for tok in text.split()]
+    return " ".join(f'"{tok}"' for tok in tokens if tok)
+
+def search_messages(query, page=0, page_size=SEARCH_PAGE_SIZE):
+    # ranked (bm25) search over message texts; fetches one extra row to know if there is a next page
+    q = fts_query(query)
+    if not q:
+        return [], False
+    rows = db_execute("""
+        SELECT m.id, m.sender_id, m.receiver_id, snippet(messages_fts, 0, '[', ']', '…', 12)
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+        ORDER BY messages_fts.rank
+        LIMIT ? OFFSET ?
+    """, (q, page_size + 1, page * page_size), fetchall=True) or []
+    return rows[:page_size], len(rows) > page_size
+
+def search_reports(query, page=0, page_size=SEARCH_PAGE_SIZE):
+    # ranked search over report reasons, resolved to the reported message
+    q = fts_query(query)
+    if not q:
+        return [], False
+    rows = db_execute("""
+        SELECT m.id, m.sender_id, m.receiver_id, snippet(reports_fts, 0, '[', ']', '…', 12)
+        FROM reports_fts
+        JOIN reports r ON r.id = reports_fts.rowid
+        JOIN messages m ON m.id = r.message_id
+        WHERE reports_fts MATCH ?
+        ORDER BY reports_fts.rank
+        LIMIT ? OFFSET ?
+    """, (q, page_size + 1, page * page_size), fetchall=True) or []
+    return rows[:page_size], len(rows) > page_size
+
+def rebuild_search_index(batch=5000):
+    # FTS5 'rebuild'/'optimize' hold the write lock for the whole table, long enough on big DBs for
+    # concurrent create_message/add_report to fail with "database is locked". Instead re-index in
+    # short transactions: clear the index, refill it in id batches, then compact with small 'merge' steps.
+    # Rows inserted meanwhile go in through the triggers, so the refill stops at the id seen at the start.
+    # After each transaction we sleep as long as it took, otherwise waiting writers (whose busy handler
+    # backs off) never get the lock between batches. Searches return partial results until the refill is done.
+    con = sqlite3.connect(DB_PATH)
+    try:
+        for table, fts, col in (("messages", "messages_fts", "text"), ("reports", "reports_fts", "reason")):
+            with con:
+                max_id = con.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                con.execute(f"INSERT INTO {fts}({fts}) VALUES ('delete-all')")
+            last_id = 0
+            while last_id < max_id:
+                started = time.monotonic()
+                with con:
+                    row = con.execute(f"SELECT MAX(id) FROM (SELECT id FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+                                      (last_id, max_id, batch)).fetchone()
+                    if row[0] is None:
+                        break
+                    con.execute(f"INSERT INTO {fts}(rowid, {col}) SELECT id, {col} FROM {table} WHERE id > ? AND id <= ?",
+                                (last_id, row[0]))
+                last_id = row[0]
+                time.sleep(time.monotonic() - started)
+            while True:
+                # per the FTS5 docs, a 'merge' that changes fewer than 2 rows means there is nothing left to merge
+                started = time.monotonic()
+                before = con.total_changes
+                with con:
+                    con.execute(f"INSERT INTO {fts}({fts}, rank) VALUES ('merge', 500)")
+                if con.total_changes - before < 2:
+                    break
+                time.sleep(time.monotonic() - started)
+    finally:
+        con.close()
+
+def create_broadcast(text):
+    # the audience is snapshotted as 'pending' delivery rows, so users who start the bot later
+    # (whatever their Telegram id) are neither sent to nor counted in total
+    ts = int(time.time())
+    con = sqlite3.connect(DB_PATH)
+    with con:
+        bid = con.execute("INSERT INTO broadcasts (text, created_at) VALUES (?, ?)", (text, ts)).lastrowid
+        total = con.execute("INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, created_at) SELECT ?, user_id, 'pending', ? FROM users",
+                            (bid, ts)).rowcount
+        con.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, bid))
+    con.close()
+    return bid
+
+def get_broadcast(broadcast_id):
+    return db_execute("SELECT id, text, status, last_user_id, total, sent, failed, progress_message_id FROM broadcasts WHERE id = ?",
+                      (broadcast_id,), fetchone=True)
+
+def get_running_broadcasts():
+    return [r[0] for r in db_execute("SELECT id FROM broadcasts WHERE status = 'running'", fetchall=True) or []]
+
+def set_broadcast_status(broadcast_id, status):
+    finished = int(time.time()) if status in ("done", "cancelled") else None
+    db_execute("UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?", (status, finished, broadcast_id), commit=True)
+
+def set_broadcast_progress_message(broadcast_id, message_id):
+    db_execute("UPDATE broadcasts SET progress_message_id = ? WHERE id = ?", (message_id, broadcast_id), commit=True)
+
+def get_broadcast_batch(broadcast_id, after_user_id, limit=BROADCAST_BATCH):
+    # keyset scan over the snapshotted audience (primary key broadcast_id, user_id), never OFFSET
+    rows = db_execute("""
+        SELECT user_id FROM broadcast_deliveries
+        WHERE broadcast_id = ? AND user_id > ? AND status = 'pending'
+        ORDER BY user_id LIMIT ?
+    """, (broadcast_id, after_user_id, limit), fetchall=True)
+    return [r[0] for r in rows or []]
+
+def record_delivery(broadcast_id, user_id, status, error=None):
+    # delivery outcome and checkpoint are written in one transaction so a crash never skips or double-counts a user
+    ts = int(time.time())
+    counter = "sent" if status == "sent" else "failed"
+    con = sqlite3.connect(DB_PATH)
+    with con:
+        con.execute("UPDATE broadcast_deliveries SET status = ?, error = ?, created_at = ? WHERE broadcast_id = ? AND user_id = ?",
+                    (status, error, ts, broadcast_id, user_id))
+        con.execute(f"UPDATE broadcasts SET last_user_id = ?, {counter} = {counter} + 1 WHERE id = ?",
+                    (user_id, broadcast_id))
+    con.close()
+
 def get_stats(user_id):
     start_today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
     m_today = db_execute("SELECT COUNT(*) FROM messages WHERE receiver_id = ? AND created_at >= ?", (user_id, int(start_today)), fetchone=True)[0]
@@ -361,6 +769,88 @@ def get_stats(user_id):
     unique = db_execute("SELECT COUNT(DISTINCT sender_id) FROM messages WHERE receiver_id = ?", (user_id,), fetchone=True)[0]
     return {"m_today": m_today, "m_total": m_total, "v_today": v_today, "v_total": v_total, "unique": unique}
 
+# ----------------------------
+# Analytics (HyperLogLog sketches + counters, one row per UTC day)
+# ----------------------------
+_sketch_cache = {}  # (day, metric) -> bytearray of registers, only for the current day
+
+def utc_day(ts=None):
+    return datetime.fromtimestamp(ts if ts is not None else time.time(), timezone.utc).strftime("%Y-%m-%d")
+
+def hll_add(registers, value):
+    # returns True if a register changed (i.e. the sketch must be persisted)
+    h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+    idx = h >> (64 - HLL_P)
+    rest = h & ((1 << (64 - HLL_P)) - 1)
+    rank = (64 - HLL_P) - rest.bit_length() + 1
+    if rank > registers[idx]:
+        registers[idx] = rank
+        return True
+    return False
+
+def hll_merge(sketches):
+    merged = bytearray(1 << HLL_P)
+    for regs in sketches:
+        for i, r in enumerate(regs):
+            if r > merged[i]:
+                merged[i] = r
+    return merged
+
+def hll_count(registers):
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        # small-range correction (linear counting)
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+def track_unique(metric, value):
+    day = utc_day()
+    key = (day, metric)
+    regs = _sketch_cache.get(key)
+    if regs is None:
+        # new day: drop yesterday's sketches from memory, they are already persisted
+        for old in [k for k in _sketch_cache if k[0] != day]:
+            del _sketch_cache[old]
+        row = db_execute("SELECT registers FROM daily_sketches WHERE day = ? AND metric = ?", key, fetchone=True)
+        regs = bytearray(row[0]) if row else bytearray(1 << HLL_P)
+        _sketch_cache[key] = regs
+    if hll_add(regs, value):
+        db_execute("INSERT OR REPLACE INTO daily_sketches (day, metric, registers) VALUES (?, ?, ?)",
+                   (day, metric, bytes(regs)), commit=True)
+
+def track_counter(metric, amount=1):
+    db_execute("""
+        INSERT INTO daily_counters (day, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value
+    """, (utc_day(), metric, amount), commit=True)
+
+def get_period_analytics(days):
+    # merge the last `days` daily sketches (today included) into one view
+    start = utc_day(time.time() - (days - 1) * 86400)
+    sketches = {}
+    for metric, regs in db_execute("SELECT metric, registers FROM daily_sketches WHERE day >= ?", (start,), fetchall=True) or []:
+        sketches.setdefault(metric, []).append(regs)
+    counters = dict(db_execute("SELECT metric, SUM(value) FROM daily_counters WHERE day >= ? GROUP BY metric", (start,), fetchall=True) or [])
+    result = {m: hll_count(hll_merge(sketches.get(m, []))) for m in ("active_users", "senders", "receivers", "visitors")}
+    result["messages"] = counters.get("messages", 0)
+    result["visits"] = counters.get("visits", 0)
+    return result
+
+def render_dashboard():
+    msg = f"📊 Dashboard (unique counts ±{HLL_ERROR * 100:.1f}%)\n"
+    for label, days in (("Today", 1), ("7 days", 7), ("30 days", 30)):
+        a = get_period_analytics(days)
+        conversion = a["senders"] / a["visitors"] * 100 if a["visitors"] else 0.0
+        msg += (f"\n{label}:\n"
+                f"• active users: {a['active_users']}\n"
+                f"• unique senders: {a['senders']} • active receivers: {a['receivers']}\n"
+                f"• messages: {a['messages']} • visits: {a['visits']} (unique visitors: {a['visitors']})\n"
+                f"• visitor → sender conversion: {conversion:.1f}%\n")
+    return msg
+
 # ----------------------------
 # Utilities
 # ----------------------------
@@ -377,9 +867,17 @@ def t(key, user_id=None, **kwargs):
         return txt.format(**kwargs)
     return txt
 
+def shorten(text, limit):
+    text = text or ""
+    return text[:limit] + "..." if len(text) > limit else text
+
 async def safe_send(user_id: int, text: str, reply_markup=None, parse_mode=None):
     try:
-        return await bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        started = time.perf_counter()
+        sent = await bot.send_message(user_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        if debug_sampled():
+            log_debug("safe_send", to=user_id, duration_ms=round((time.perf_counter() - started) * 1000, 2))
+        return sent
     except Exception as e:
         logger.warning("Failed to send to %s: %s", user_id, e)
         return None
@@ -405,6 +903,165 @@ def make_receiver_kb(message_id, user_id):
     # Also add a small "reply back" when sender sees reply
     return kb
 
+def make_search_kb(scope, page, has_next):
+    kb = InlineKeyboardMarkup(row_width=2)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f"search:{scope}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"search:{scope}:{page + 1}"))
+    if buttons:
+        kb.add(*buttons)
+    return kb
+
+def render_search_page(scope, query, page):
+    if scope == "reports":
+        rows, has_next = search_reports(query, page)
+    else:
+        rows, has_next = search_messages(query, page)
+    if not rows:
+        return f"No results for: {query}", None
+    msg = f"🔎 {scope} matching \"{query}\" (page {page + 1}):\n"
+    for mid, sender_id, receiver_id, snip in rows:
+        msg += f"- #{mid} from {sender_id} to {receiver_id}: {snip}\n"
+    return msg, make_search_kb(scope, page, has_next)
+
+def make_page_nav(prefix, rows, has_older, has_newer):
+    # rows are newest first; "older" continues below the last row, "newer" above the first one
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("◀️ Новее / Newer", callback_data=f"{prefix}:newer:{rows[0][0]}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("Старее / Older ▶️", callback_data=f"{prefix}:older:{rows[-1][0]}"))
+    return buttons
+
+def render_inbox_page(user_id, cursor=0, direction="older"):
+    rows, has_older, has_newer = get_inbox_page(user_id, cursor, direction)
+    if not rows:
+        return t("inbox_empty", user_id), None
+    msg = t("inbox_header", user_id) + "\n"
+    kb = InlineKeyboardMarkup(row_width=5)
+    for mid, text, created_at, n_replies in rows:
+        preview = shorten(text, 80)
+        when = datetime.fromtimestamp(created_at, timezone.utc).strftime("%d.%m %H:%M")
+        msg += f"\n#{mid} · {when} · 💬{n_replies}\n{preview}\n"
+    kb.add(*[InlineKeyboardButton(f"🧵 #{r[0]}", callback_data=f"thread:{r[0]}:older:0") for r in rows])
+    nav = make_page_nav("inbox", rows, has_older, has_newer)
+    if nav:
+        kb.row(*nav)
+    return msg, kb
+
+def render_thread_page(user_id, dbm, cursor=0, direction="older"):
+    mid = dbm[0]
+    rows, has_older, has_newer = get_thread_page(mid, cursor, direction)
+    msg = t("thread_header", user_id, mid=mid, text=shorten(dbm[5], THREAD_TEXT_LIMIT)) + "\n\n"
+    if not rows:
+        msg += t("thread_no_replies", user_id)
+    # show the page in chronological order
+    for rid, author_id, text, created_at in reversed(rows):
+        who = t("thread_you", user_id) if author_id == user_id else t("thread_them", user_id)
+        when = datetime.fromtimestamp(created_at, timezone.utc).strftime("%d.%m %H:%M")
+        msg += f"{who} ({when}): {shorten(text, THREAD_TEXT_LIMIT)}\n"
+    kb = InlineKeyboardMarkup(row_width=2)
+    nav = make_page_nav(f"thread:{mid}", rows, has_older, has_newer)
+    if nav:
+        kb.row(*nav)
+    kb.add(InlineKeyboardButton("💬 Ответить / Reply", callback_data=f"reply:{mid}"))
+    return msg, kb
+
+def make_broadcast_kb(broadcast_id, status):
+    kb = InlineKeyboardMarkup(row_width=2)
+    if status == "running":
+        kb.add(InlineKeyboardButton("⏸ Pause", callback_data=f"admin:broadcast:pause:{broadcast_id}"),
+               InlineKeyboardButton("✖️ Cancel", callback_data=f"admin:broadcast:cancel:{broadcast_id}"))
+    elif status == "paused":
+        kb.add(InlineKeyboardButton("▶️ Resume", callback_data=f"admin:broadcast:resume:{broadcast_id}"),
+               InlineKeyboardButton("✖️ Cancel", callback_data=f"admin:broadcast:cancel:{broadcast_id}"))
+    return kb
+
+def render_broadcast_progress(broadcast_id, rate=0.0):
+    bid, text, status, last_user_id, total, sent, failed, pmid = get_broadcast(broadcast_id)
+    done = sent + failed
+    msg = f"📣 Broadcast #{bid}: {status}\nProcessed {done}/{total} • sent {sent} • failed {failed}"
+    if status == "running" and rate > 0:
+        eta = max(total - done, 0) / rate
+        msg += f"\n{rate:.1f} msg/s • ETA {int(eta // 60)}m {int(eta % 60)}s"
+    return msg, make_broadcast_kb(bid, status)
+
+async def update_broadcast_progress(broadcast_id, rate=0.0):
+    pmid = get_broadcast(broadcast_id)[7]
+    text, kb = render_broadcast_progress(broadcast_id, rate)
+    try:
+        await bot.edit_message_text(text, chat_id=ADMIN_ID, message_id=pmid, reply_markup=kb)
+    except Exception as e:
+        logger.warning("Failed to update broadcast %s progress: %s", broadcast_id, e)
+
+async def wait_broadcast_slot():
+    # one global pacer: concurrent broadcasts share BROADCAST_RATE instead of each getting its own
+    global broadcast_next_send
+    now = time.monotonic()
+    slot = max(broadcast_next_send, now)
+    broadcast_next_send = slot + 1.0 / BROADCAST_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def deliver_broadcast_message(user_id, text):
+    # returns (status, error); waits out flood control instead of dropping the user
+    global broadcast_next_send
+    while True:
+        await wait_broadcast_slot()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent", None
+        except TelegramRetryAfter as e:
+            # flood control is per bot, so push back every broadcast, not just this one
+            broadcast_next_send = max(broadcast_next_send, time.monotonic() + e.retry_after)
+        except TelegramForbiddenError as e:
+            return "blocked", str(e)
+        except Exception as e:
+            return "failed", str(e)
+
+async def run_broadcast(broadcast_id):
+    row = get_broadcast(broadcast_id)
+    text, last_user_id = row[1], row[3]
+    started, sent_here = time.monotonic(), 0
+    last_progress = 0.0
+    try:
+        while broadcast_status.get(broadcast_id) == "running":
+            batch = get_broadcast_batch(broadcast_id, last_user_id)
+            if not batch:
+                set_broadcast_status(broadcast_id, "done")
+                broadcast_status[broadcast_id] = "done"
+                break
+            for user_id in batch:
+                if broadcast_status.get(broadcast_id) != "running":
+                    break
+                status, error = await deliver_broadcast_message(user_id, text)
+                # checkpoint off the event loop so handlers stay responsive during long broadcasts
+                await asyncio.to_thread(record_delivery, broadcast_id, user_id, status, error)
+                last_user_id = user_id
+                sent_here += 1
+                now = time.monotonic()
+                if now - last_progress >= BROADCAST_PROGRESS_EVERY:
+                    last_progress = now
+                    await update_broadcast_progress(broadcast_id, sent_here / (now - started))
+    except Exception as e:
+        # leave status 'running' so the broadcast resumes from its checkpoint on next start
+        logger.exception("Broadcast %s crashed: %s", broadcast_id, e)
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+    await update_broadcast_progress(broadcast_id)
+
+def start_broadcast_task(broadcast_id):
+    if broadcast_id not in broadcast_tasks:
+        # set before the task runs so a pause/cancel arriving in between is not overwritten
+        broadcast_status[broadcast_id] = "running"
+        # own log context: the task outlives the /broadcast update and must not inherit its cid or sampling
+        ctx = contextvars.Context()
+        ctx.run(log_context.set, {"cid": uuid.uuid4().hex[:12], "user_id": None,
+                                  "route": f"broadcast:{broadcast_id}", "sampled": False})
+        broadcast_tasks[broadcast_id] = asyncio.create_task(run_broadcast(broadcast_id), context=ctx)
+
 def make_menu_kb(user_id):
     kb = InlineKeyboardMarkup(row_width=1)
     kb.add(InlineKeyboardButton(t("menu_text", user_id), callback_data="menu:open"))
@@ -469,6 +1126,55 @@ async def cmd_start(message: types.Message):
     pending_send_for_target[uid] = target_id
     await message.answer(t("enter_message_prompt", uid))
 
+@dp.message(Command(commands=["inbox"]))
+async def cmd_inbox(message: types.Message):
+    uid = message.from_user.id
+    ensure_user(uid, message.from_user.username, message.from_user.first_name)
+    text, kb = render_inbox_page(uid)
+    await message.answer(text, reply_markup=kb)
+
+@dp.message(Command(commands=["search", "search_reports"]))
+async def cmd_search(message: types.Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer(f"Usage: /{command.command} <words>")
+        return
+    scope = "reports" if command.command == "search_reports" else "messages"
+    admin_search_query[ADMIN_ID] = (scope, query)
+    text, kb = render_search_page(scope, query, 0)
+    await message.answer(text, reply_markup=kb)
+
+@dp.message(Command(commands=["dashboard"]))
+async def cmd_dashboard(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(render_dashboard())
+
+@dp.message(Command(commands=["broadcast"]))
+async def cmd_broadcast(message: types.Message, command: CommandObject):
+    if message.from_user.id != ADMIN_ID:
+        return
+    text = (command.args or "").strip()
+    if not text:
+        await message.answer("Usage: /broadcast <text>")
+        return
+    # snapshotting the audience scans all users, keep it off the event loop
+    bid = await asyncio.to_thread(create_broadcast, text)
+    progress = await message.answer(f"📣 Broadcast #{bid}: starting...")
+    set_broadcast_progress_message(bid, progress.message_id)
+    start_broadcast_task(bid)
+
+@dp.message(Command(commands=["reindex"]))
+async def cmd_reindex(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    started = time.monotonic()
+    # touches every indexed row, keep it off the event loop (it commits in small batches, writers are not blocked)
+    await asyncio.to_thread(rebuild_search_index)
+    await message.answer(f"Search index rebuilt and optimized in {time.monotonic() - started:.1f}s")
+
 @dp.callback_query()
 async def callbacks_handler(callback: types.CallbackQuery):
     data = callback.data or ""
@@ -504,7 +1210,8 @@ async def callbacks_handler(callback: types.CallbackQuery):
     # Menu open or options
     if data == "menu:open":
         kb = InlineKeyboardMarkup(row_width=1)
-        kb.add(InlineKeyboardButton("📊 Статистика / Statistics", callback_data="menu:stats"),
+        kb.add(InlineKeyboardButton("📥 Входящие / Inbox", callback_data="inbox:open"),
+               InlineKeyboardButton("📊 Статистика / Statistics", callback_data="menu:stats"),
                InlineKeyboardButton("💡 Предложить идею / Idea", callback_data="menu:idea"),
                InlineKeyboardButton("🛠 Техподдержка / Support", callback_data="menu:support"),
                InlineKeyboardButton("⚙️ Настройки / Settings", callback_data="menu:settings"))
@@ -524,6 +1231,34 @@ async def callbacks_handler(callback: types.CallbackQuery):
         await callback.answer()
         return
 
+    # Inbox: inbox:open or inbox:<older|newer>:<cursor id>
+    if data.startswith("inbox:"):
+        if data == "inbox:open":
+            text, kb = render_inbox_page(uid)
+            await bot.send_message(uid, text, reply_markup=kb)
+        else:
+            _, direction, cursor = data.split(":")
+            text, kb = render_inbox_page(uid, int(cursor), direction)
+            await callback.message.edit_text(text, reply_markup=kb)
+        await callback.answer()
+        return
+
+    # Thread view: thread:<message id>:<older|newer>:<cursor id> (cursor 0 = latest replies)
+    if data.startswith("thread:"):
+        _, mid, direction, cursor = data.split(":")
+        dbm = get_message(int(mid))
+        # only the two participants may read a thread
+        if not dbm or uid not in (dbm[1], dbm[4]):
+            await callback.answer("Error", show_alert=True)
+            return
+        text, kb = render_thread_page(uid, dbm, int(cursor), direction)
+        if cursor == "0" and direction == "older":
+            await bot.send_message(uid, text, reply_markup=kb)
+        else:
+            await callback.message.edit_text(text, reply_markup=kb)
+        await callback.answer()
+        return
+
     # Menu idea
     if data == "menu:idea":
         pending_idea_from_user[callback.from_user.id] = True
@@ -612,6 +1347,49 @@ async def callbacks_handler(callback: types.CallbackQuery):
         await callback.answer()
         return
 
+    # Admin search pagination: search:<scope>:<page>
+    if data.startswith("search:"):
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("Only admin", show_alert=True)
+            return
+        _, scope, page = data.split(":")
+        last = admin_search_query.get(ADMIN_ID)
+        if not last or last[0] != scope:
+            await callback.answer("Search expired, run it again", show_alert=True)
+            return
+        text, kb = render_search_page(scope, last[1], max(int(page), 0))
+        await callback.message.edit_text(text, reply_markup=kb)
+        await callback.answer()
+        return
+
+    # Admin broadcast control: admin:broadcast:<pause|resume|cancel>:<broadcast_id>
+    if data.startswith("admin:broadcast:"):
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("Only admin", show_alert=True)
+            return
+        _, _, action, bid = data.split(":")
+        bid = int(bid)
+        row = get_broadcast(bid)
+        if not row or row[2] in ("done", "cancelled"):
+            await callback.answer("Broadcast already finished", show_alert=True)
+            return
+        if action == "pause":
+            set_broadcast_status(bid, "paused")
+            broadcast_status[bid] = "paused"
+        elif action == "cancel":
+            set_broadcast_status(bid, "cancelled")
+            broadcast_status[bid] = "cancelled"
+        elif action == "resume":
+            set_broadcast_status(bid, "running")
+            # a sender loop that has not noticed the pause yet simply keeps going
+            broadcast_status[bid] = "running"
+            start_broadcast_task(bid)
+        # the sender loop refreshes the message itself when it stops; refresh now if it is idle
+        if bid not in broadcast_tasks:
+            await update_broadcast_progress(bid)
+        await callback.answer({"pause": "Broadcast paused", "resume": "Broadcast resumed", "cancel": "Broadcast cancelled"}.get(action, ""))
+        return
+
     # Admin actions: block/unblock/ban via callback_data like admin:block:12345
     if data.startswith("admin:block:") or data.startswith("admin:unblock:") or data.startswith("admin:ban:") or data.startswith("admin:process_appeal:"):
         # only admin allowed
@@ -711,10 +1489,17 @@ async def on_message(message: types.Message):
             if not dbm:
                 await message.answer("Original message not found.")
                 return
-            sender_id = dbm[1]
-            # send anonymous reply to original sender
-            await safe_send(sender_id, t("reply_notification_to_sender", sender_id, reply=text),
-                            reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("💬 Reply", callback_data=f"reply_to_sender:{mid}")))
+            sender_id, receiver_id = dbm[1], dbm[4]
+            if uid not in (sender_id, receiver_id):
+                await message.answer("Original message not found.")
+                return
+            # the other side of the thread: receiver answers the sender and vice versa
+            recipient_id = receiver_id if uid == sender_id else sender_id
+            add_reply(mid, uid, recipient_id, text)
+            kb = InlineKeyboardMarkup(row_width=2)
+            kb.add(InlineKeyboardButton("💬 Reply", callback_data=f"reply_to_sender:{mid}"),
+                   InlineKeyboardButton("🧵 Thread", callback_data=f"thread:{mid}:older:0"))
+            await safe_send(recipient_id, t("reply_notification_to_sender", recipient_id, reply=text), reply_markup=kb)
             await message.answer(t("message_sent_confirm", uid))
         except Exception as e:
             logger.exception("Error in reply flow: %s", e)
@@ -748,6 +1533,13 @@ async def on_message(message: types.Message):
 # ----------------------------
 # Startup
 # ----------------------------
+@dp.startup()
+async def on_startup():
+    # resume broadcasts interrupted by a restart/crash from their checkpoint
+    for bid in get_running_broadcasts():
+        logger.info("Resuming broadcast %s", bid)
+        start_broadcast_task(bid)
+
 if __name__ == "__main__":
     init_db()
     logger.info("Bot starting...")